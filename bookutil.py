@@ -0,0 +1,273 @@
+"""Shared plumbing for the polyglot book builder scripts.
+
+The builder scripts differ only in their constants and in how a move is
+scored; everything else (PGN splitting, SAN tokenizing, incremental
+Zobrist hashing, weight bookkeeping, the .bin writer) lives here so each
+optimization lands in one place.
+"""
+
+import concurrent.futures
+import functools
+import os
+import re
+import numpy as np
+import chess
+import chess.polyglot
+import chess.variant
+
+# We only need the mainline SAN tokens plus a couple of headers, so the
+# movetext is tokenized directly instead of paying for chess.pgn's full
+# game-tree parse. Move numbers, results and NAGs don't match the
+# pattern; comments are stripped beforehand.
+TAG_RE = re.compile(r'^\[(\w+) "([^"]*)"\]', re.MULTILINE)
+COMMENT_RE = re.compile(r"\{[^}]*\}")
+SAN_RE = re.compile(
+    r"(?:O-O-O|O-O|[KQRBN]?[a-h]?[1-8]?x?[a-h][1-8](?:=[QRBNK])?)[+#]?")
+
+# The Variant tag takes a handful of fixed spellings, so memoize the
+# normalized check instead of allocating lower()/replace() copies per game.
+_variant_ok_cache: dict[tuple[str, str], bool] = {}
+
+
+def variant_ok(variant: str, tag: str) -> bool:
+    ok = _variant_ok_cache.get((variant, tag))
+    if ok is None:
+        ok = variant == "standard" or variant in tag.lower().replace(" ", "")
+        _variant_ok_cache[(variant, tag)] = ok
+    return ok
+
+
+class Book:
+    def __init__(self, max_weight: int):
+        self.max_weight = max_weight
+        # Zobrist key -> {packed polyglot move -> weight}. Plain nested
+        # dicts of ints: no per-move object or UCI string overhead.
+        self.positions: dict[int, dict[int, int]] = {}
+
+    def get_position(self, key: int) -> dict[int, int]:
+        return self.positions.setdefault(key, {})
+
+    def merge(self, positions: dict[int, dict[int, int]]):
+        """Add another book's weights into this one. Addition is
+        associative, so partial books can be merged in any order."""
+        for key, partial_moves in positions.items():
+            moves = self.positions.setdefault(key, {})
+            for mi, w in partial_moves.items():
+                moves[mi] = moves.get(mi, 0) + w
+
+    def normalize(self, jitter: int = 0, floor: int = 1):
+        """Rescale every position's weights to max_weight in one flat
+        NumPy pass (CSR-style offsets + reduceat) instead of a Python loop
+        per move. With jitter > 0, random noise in [0, jitter] is added to
+        every weight as well; floor is the minimum weight a move keeps."""
+        position_moves = [m for m in self.positions.values() if m]
+        n = len(position_moves)
+        if n == 0:
+            return
+        counts = np.fromiter((len(m) for m in position_moves),
+                             dtype=np.int64, count=n)
+        total = int(counts.sum())
+        weights = np.fromiter(
+            (w for m in position_moves for w in m.values()),
+            dtype=np.float64, count=total)
+        offsets = np.zeros(n, dtype=np.int64)
+        np.cumsum(counts[:-1], out=offsets[1:])
+        sums = np.repeat(np.add.reduceat(weights, offsets), counts)
+        scaled = np.maximum(
+            floor,
+            (weights / np.maximum(sums, 1) * self.max_weight).astype(np.int64))
+        # Positions whose weights sum to zero keep their original weights.
+        scaled = np.where(sums > 0, scaled, weights.astype(np.int64))
+        if jitter:
+            scaled = np.minimum(
+                scaled + np.random.randint(0, jitter + 1, size=total),
+                self.max_weight)
+        it = iter(scaled.tolist())
+        for moves in position_moves:
+            for mi in moves:
+                moves[mi] = next(it)
+
+    # Big-endian fields match the on-disk polyglot entry layout, so the
+    # sorted array can be dumped with a single tofile call.
+    ENTRY_DTYPE = np.dtype([("key", ">u8"), ("move", ">u2"),
+                            ("weight", ">u2"), ("learn", ">u4")])
+
+    def save_polyglot(self, path: str):
+        entries = [(key, mi, min(self.max_weight, w))
+                   for key, moves in self.positions.items()
+                   for mi, w in moves.items() if w > 0]
+        arr = np.empty(len(entries), dtype=self.ENTRY_DTYPE)
+        if entries:
+            keys, mis, weights = zip(*entries)
+            arr["key"] = keys
+            arr["move"] = mis
+            arr["weight"] = weights
+        arr["learn"] = 0
+        arr.sort(order=["key", "move"])
+        arr.tofile(path)
+        print(f"Saved {len(arr)} moves to book: {path}")
+
+
+_RANDOM_ARRAY = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+_HASHER = chess.polyglot.ZobristHasher(_RANDOM_ARRAY)
+
+# Board classes where a push only ever changes the moved/captured/rook
+# squares, so the incremental update in zobrist_push is exact; each one
+# was fuzzed against a full chess.polyglot.zobrist_hash recompute.
+# Atomic explosions clear neighboring squares, so atomic -- and any
+# variant not verified here -- replays with a full rehash per ply.
+INCREMENTAL_HASH_BOARDS = frozenset({
+    chess.Board,
+    chess.variant.KingOfTheHillBoard,
+    chess.variant.AntichessBoard,
+    chess.variant.HordeBoard,
+    chess.variant.ThreeCheckBoard,
+    chess.variant.RacingKingsBoard,
+    chess.variant.CrazyhouseBoard,
+})
+
+
+def zobrist_push(board: chess.Board, move: chess.Move, h: int,
+                 array=_RANDOM_ARRAY,
+                 hash_castling=_HASHER.hash_castling,
+                 hash_ep_square=_HASHER.hash_ep_square) -> int:
+    """Push move on board and return the polyglot hash updated incrementally.
+
+    Only the squares the move touches get re-hashed, instead of the full
+    64-square scan chess.polyglot.zobrist_hash does on every call. The
+    random array and hasher methods are bound as default args so the
+    per-call reads are LOAD_FAST instead of module/attribute lookups.
+
+    Only exact for board classes in INCREMENTAL_HASH_BOARDS: variants
+    whose pushes have side effects beyond the move's own squares (e.g.
+    atomic explosions) need a full rehash instead.
+    """
+    h ^= hash_castling(board) ^ hash_ep_square(board)
+    squares = {move.from_square, move.to_square}
+    if board.is_en_passant(move):
+        # The captured pawn sits behind the en passant square.
+        squares.add(move.to_square + (-8 if board.turn == chess.WHITE else 8))
+    elif board.is_castling(move):
+        rank = chess.square_rank(move.from_square)
+        if chess.square_file(move.to_square) > chess.square_file(move.from_square):
+            squares.update((chess.square(7, rank), chess.square(5, rank)))
+        else:
+            squares.update((chess.square(0, rank), chess.square(3, rank)))
+    before = [(s, board.piece_at(s)) for s in squares]
+    board.push(move)
+    for s, piece in before:
+        if piece:
+            h ^= array[64 * ((piece.piece_type - 1) * 2 + piece.color) + s]
+        piece = board.piece_at(s)
+        if piece:
+            h ^= array[64 * ((piece.piece_type - 1) * 2 + piece.color) + s]
+    h ^= hash_castling(board) ^ hash_ep_square(board)
+    return h ^ array[780]
+
+
+def add_game_to_book(book, tags, movetext, score_fn, max_ply, variant,
+                     board_class) -> bool:
+    """Fold one game into the book. Returns False if the variant filter
+    rejected the game. score_fn(result, turn, ply) -> weight delta."""
+    if not variant_ok(variant, tags.get("Variant", "")):
+        return False
+
+    board = board_class()
+    h = chess.polyglot.zobrist_hash(board)
+    result = tags.get("Result", "*")
+    incremental = board_class in INCREMENTAL_HASH_BOARDS
+    # Bind the per-ply lookups to locals outside the loop
+    parse_san = board.parse_san
+    get_position = book.get_position
+
+    for ply, san in enumerate(SAN_RE.findall(COMMENT_RE.sub(" ", movetext))):
+        if ply >= max_ply:
+            break
+        try:
+            move = parse_san(san)
+            moves = get_position(h)
+            # 16-bit polyglot move encoding, inline to skip a call per ply
+            mi = move.to_square | (move.from_square << 6)
+            if move.promotion:
+                mi |= (move.promotion - 1) << 12
+
+            delta = score_fn(result, board.turn, ply)
+            if delta:
+                moves[mi] = moves.get(mi, 0) + delta
+            else:
+                moves.setdefault(mi, 0)
+
+            if incremental:
+                h = zobrist_push(board, move, h)
+            else:
+                board.push(move)
+                h = chess.polyglot.zobrist_hash(board)
+        except Exception:
+            break
+    return True
+
+
+def iter_game_texts(stream):
+    """Yield one PGN game at a time as raw text, splitting on the header
+    block that follows each game's movetext."""
+    lines: list[str] = []
+    in_movetext = False
+    for line in stream:
+        if line.startswith("[") and in_movetext:
+            yield "".join(lines)
+            lines = []
+            in_movetext = False
+        elif line.strip() and not line.startswith("["):
+            in_movetext = True
+        lines.append(line)
+    if lines:
+        yield "".join(lines)
+
+
+def build_partial_book(game_texts, score_fn, max_weight, max_ply, variant,
+                       board_class):
+    """Worker: build a partial book from a shard of raw game texts."""
+    book = Book(max_weight)
+    processed = 0
+    kept = 0
+    for text in game_texts:
+        header_text, _, movetext = text.partition("\n\n")
+        if not movetext.strip():
+            continue
+        processed += 1
+        if add_game_to_book(book, dict(TAG_RE.findall(header_text)), movetext,
+                            score_fn, max_ply, variant, board_class):
+            kept += 1
+    return book.positions, processed, kept
+
+
+def build_book_from_pgn(pgn_path: str, score_fn, max_weight: int,
+                        max_ply: int, variant: str = "standard") -> Book:
+    """Build a Book from a PGN file, scoring each ply with score_fn."""
+    print("Building book from local PGN...")
+    board_class = (chess.Board if variant == "standard"
+                   else chess.variant.find_variant(variant))
+    book = Book(max_weight)
+
+    # The parse + replay loop is CPU-bound pure Python, so shard the
+    # games round-robin across processes and merge the partial books;
+    # weight addition is associative, so merge order does not matter.
+    workers = os.cpu_count() or 1
+    shards: list[list[str]] = [[] for _ in range(workers)]
+    with open(pgn_path, "r", encoding="utf-8", buffering=1 << 20) as stream:
+        for i, text in enumerate(iter_game_texts(stream)):
+            shards[i % workers].append(text)
+
+    worker = functools.partial(build_partial_book, score_fn=score_fn,
+                               max_weight=max_weight, max_ply=max_ply,
+                               variant=variant, board_class=board_class)
+    processed = 0
+    kept = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for partial, shard_processed, shard_kept in executor.map(worker, shards):
+            processed += shard_processed
+            kept += shard_kept
+            book.merge(partial)
+
+    print(f"Parsed {processed} PGNs, kept {kept} games")
+    return book
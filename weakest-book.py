@@ -1,8 +1,7 @@
-import io
 import random
 import chess
-import chess.pgn
-import chess.polyglot
+
+from bookutil import build_book_from_pgn
 
 PGN_INPUT = "MinOpponentMoves_wins.pgn"
 BOOK_OUTPUT = "MinOpponentMoves_wins_book.bin"
@@ -12,123 +11,27 @@ MAX_BOOK_WEIGHT = 2520
 
 VARIANT = "standard"
 
+# Per-ply weight decay, resolved once instead of recomputed every ply
+DECAY = [max(1, (MAX_PLY - ply) // 5) for ply in range(MAX_PLY)]
 
-class BookMove:
-    def __init__(self):
-        self.weight = 0
-        self.move: chess.Move | None = None
-
-
-class BookPosition:
-    def __init__(self):
-        self.moves: dict[str, BookMove] = {}
-
-    def get_move(self, uci: str) -> BookMove:
-        return self.moves.setdefault(uci, BookMove())
-
-
-class Book:
-    def __init__(self):
-        self.positions: dict[str, BookPosition] = {}
-
-    def get_position(self, key_hex: str) -> BookPosition:
-        return self.positions.setdefault(key_hex, BookPosition())
-
-    def normalize(self):
-        for pos in self.positions.values():
-            s = sum(bm.weight for bm in pos.moves.values())
-            if s <= 0:
-                continue
-            for bm in pos.moves.values():
-                bm.weight = max(1, int(bm.weight / s * MAX_BOOK_WEIGHT))
-
-    def save_polyglot(self, path: str):
-        entries = []
-        for key_hex, pos in self.positions.items():
-            zbytes = bytes.fromhex(key_hex)
-            for uci, bm in pos.moves.items():
-                if bm.weight <= 0 or bm.move is None:
-                    continue
-                m = bm.move
-                mi = m.to_square + (m.from_square << 6)
-                if m.promotion:
-                    mi += ((m.promotion - 1) << 12)
-                mbytes = mi.to_bytes(2, "big")
-                wbytes = min(MAX_BOOK_WEIGHT, bm.weight).to_bytes(2, "big")
-                lbytes = (0).to_bytes(4, "big")
-                entries.append(zbytes + mbytes + wbytes + lbytes)
-        entries.sort(key=lambda e: (e[:8], e[10:12]))
-        with open(path, "wb") as f:
-            for e in entries:
-                f.write(e)
-        print(f"Saved {len(entries)} moves to book: {path}")
-
-
-def key_hex(board: chess.Board) -> str:
-    return f"{chess.polyglot.zobrist_hash(board):016x}"
-
-
-def build_book_from_pgn(pgn_path: str, bin_path: str):
-    print("Building book from local PGN...")
-    book = Book()
-    with open(pgn_path, "r", encoding="utf-8") as f:
-        data = f.read()
-    stream = io.StringIO(data)
+# Result tag -> the color whose moves get credited
+WINNER = {"1-0": chess.WHITE, "0-1": chess.BLACK}
 
-    processed = 0
-    kept = 0
 
-    while True:
-        game = chess.pgn.read_game(stream)
-        if game is None:
-            break
-
-        variant_tag = (game.headers.get("Variant", "") or "").lower().replace(" ", "")
-        if VARIANT not in variant_tag and VARIANT != "standard":
-            continue
-
-        board = chess.Board()
-        result = game.headers.get("Result", "*")
-        kept += 1
-
-        for ply, move in enumerate(game.mainline_moves()):
-            if ply >= MAX_PLY:
-                break
-            try:
-                k = key_hex(board)
-                pos = book.get_position(k)
-                bm = pos.get_move(move.uci())
-                bm.move = move
-
-                decay = max(1, (MAX_PLY - ply) // 5)
-
-                # Only count moves that led to MinOpponentMoves win
-                if (result == "1-0" and board.turn == chess.WHITE) or \
-                   (result == "0-1" and board.turn == chess.BLACK):
-                    bm.weight += random.randint(4, 6) * decay
-
-                board.push(move)
-            except Exception:
-                break
-
-        processed += 1
-        if processed % 100 == 0:
-            print(f"Processed {processed} games")
-
-    print(f"Parsed {processed} PGNs, kept {kept} games")
-    book.normalize()
-
-    # Add tiny random variation for even weaker book
-    for pos in book.positions.values():
-        for bm in pos.moves.values():
-            bm.weight = min(MAX_BOOK_WEIGHT, bm.weight + random.randint(0, 3))
-
-    book.save_polyglot(bin_path)
-    print("Done. Weakest book created.")
+def score_move(result: str, turn: chess.Color, ply: int) -> int:
+    # Only count moves that led to MinOpponentMoves win
+    if turn == WINNER.get(result):
+        return random.randint(4, 6) * DECAY[ply]
+    return 0
 
 
 def main():
-    build_book_from_pgn(PGN_INPUT, BOOK_OUTPUT)
+    book = build_book_from_pgn(PGN_INPUT, score_move, MAX_BOOK_WEIGHT,
+                               MAX_PLY, VARIANT)
+    # Normalize, with tiny random variation for even weaker book
+    book.normalize(jitter=3)
+    book.save_polyglot(BOOK_OUTPUT)
+    print("Done. Weakest book created.")
 
 
 if __name__ == "__main__":